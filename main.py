@@ -1,18 +1,34 @@
 #!/usr/bin/env python3
+import asyncio
 import os
+import queue
 import json
 import logging
 import datetime
+import functools
+import inspect
+import itertools
+import random
+import ssl
+import threading
 import time
-from typing import Dict, Any, Optional
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from typing import Dict, Any, Callable, Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import quote
 
+import aiohttp
+import httplib2
+import orjson
 import trino
+import numpy as np
 import pandas as pd
 from dotenv import load_dotenv
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
+from googleapiclient.discovery import Resource, build
 from googleapiclient.errors import HttpError
 
 # Set up logging
@@ -28,7 +44,72 @@ SCOPES = [
     'https://www.googleapis.com/auth/drive'
 ]
 
-def load_config() -> Dict[str, Any]:
+# Seconds before expiry at which the Google token is refreshed in the background,
+# and delay before retrying a failed background refresh
+TOKEN_REFRESH_MARGIN = 300
+TOKEN_REFRESH_RETRY_DELAY = 30
+
+# Values reported by pd.api.types.infer_dtype for object columns that json can encode as-is
+JSON_NATIVE_TYPES = {'string', 'integer', 'floating', 'mixed-integer-float', 'boolean', 'empty'}
+
+# Number of rows fetched from Trino and prepared for Google Sheets at a time
+BATCH_SIZE = 5000
+
+# Google Sheets API request payload limit (10 MB), with headroom for the JSON envelope
+MAX_REQUEST_BYTES = 9 * 1024 * 1024
+
+# Number of chunks buffered between the fetch, prepare and write stages
+PIPELINE_QUEUE_SIZE = 4
+
+# Google Sheets REST API endpoint, used directly for the concurrent value writes
+SHEETS_API_URL = 'https://sheets.googleapis.com/v4'
+
+# Maximum number of value write requests in flight at once
+MAX_CONCURRENT_WRITES = 10
+
+# Google Sheets write requests allowed per minute per user
+WRITE_REQUESTS_PER_MINUTE = 60
+
+# Standard retry parameters for Google API calls, in seconds. Quota errors
+# start from a longer delay, since Google's quotas are replenished per minute
+MAX_RETRIES = 5
+INITIAL_RETRY_DELAY = 1
+QUOTA_RETRY_DELAY = 5
+MAX_RETRY_DELAY = 60
+
+# Google API errors worth retrying
+RETRYABLE_STATUS_CODES = [429, 500, 502, 503, 504]
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+
+# Errors raised when a pooled connection to the Google APIs was closed by the server
+STALE_CONNECTION_ERRORS = (BrokenPipeError, ConnectionResetError, ssl.SSLEOFError)
+
+@dataclass(frozen=True, slots=True)
+class TrinoConfig:
+    """Trino connection settings."""
+    host: str
+    port: int
+    user: str
+    password: Optional[str]
+    catalog: str
+    schema: str
+    partition_on: Optional[str]
+    partition_num: int
+
+@dataclass(frozen=True, slots=True)
+class GoogleConfig:
+    """Google API settings."""
+    client_secret_file: str
+    token_path: str
+    drive_folder_id: str
+
+@dataclass(frozen=True, slots=True)
+class AppConfig:
+    """Configuration loaded once from environment variables."""
+    trino: TrinoConfig
+    google: GoogleConfig
+
+def load_config() -> AppConfig:
     """Load configuration from environment variables."""
     load_dotenv()
     
@@ -48,21 +129,133 @@ def load_config() -> Dict[str, Any]:
     if missing_vars:
         raise ValueError(f"Missing required environment variables: {', '.join(missing_vars)}")
     
-    return {
-        'trino': {
-            'host': os.getenv('TRINO_HOST'),
-            'port': int(os.getenv('TRINO_PORT')),
-            'user': os.getenv('TRINO_USER'),
-            'password': os.getenv('TRINO_PASSWORD'),
-            'catalog': os.getenv('TRINO_CATALOG'),
-            'schema': os.getenv('TRINO_SCHEMA'),
-        },
-        'google': {
-            'client_secret_file': os.getenv('GOOGLE_CLIENT_SECRET_FILE'),
-            'token_path': os.getenv('TOKEN_PATH'),
-            'drive_folder_id': os.getenv('DRIVE_FOLDER_ID'),
-        }
-    }
+    return AppConfig(
+        trino=TrinoConfig(
+            host=os.getenv('TRINO_HOST'),
+            port=int(os.getenv('TRINO_PORT')),
+            user=os.getenv('TRINO_USER'),
+            password=os.getenv('TRINO_PASSWORD'),
+            catalog=os.getenv('TRINO_CATALOG'),
+            schema=os.getenv('TRINO_SCHEMA'),
+            partition_on=os.getenv('TRINO_PARTITION_ON'),
+            partition_num=int(os.getenv('TRINO_PARTITION_NUM', '4')),
+        ),
+        google=GoogleConfig(
+            client_secret_file=os.getenv('GOOGLE_CLIENT_SECRET_FILE'),
+            token_path=os.getenv('TOKEN_PATH'),
+            drive_folder_id=os.getenv('DRIVE_FOLDER_ID'),
+        )
+    )
+
+class TokenRefresher:
+    """
+    Single entry point for refreshing Google credentials during the run.
+    
+    The token is refreshed on a background timer, TOKEN_REFRESH_MARGIN seconds
+    before it expires, so a long export never has a request wait on (or fail
+    with) an expired token. Requests rejected with 401 force a refresh through
+    refresh_now, and refreshes started by google-auth itself (its non-blocking
+    refresh worker, or AuthorizedHttp replaying a 401) are routed through it
+    too. All of them are serialized by one lock, and a refresh is skipped if the
+    token was already renewed by another caller in the meantime.
+    """
+    
+    def __init__(self, credentials: Credentials):
+        self.credentials = credentials
+        self.lock = threading.RLock()
+        self.timer = None
+        self.stopped = False
+        
+        # Keep the original refresh, and route google-auth's own calls through the lock
+        self.refresh_credentials = credentials.refresh
+        credentials.refresh = self.refresh_credentials_locked
+    
+    def seconds_until_refresh(self) -> float:
+        """Seconds left before the token enters the refresh margin."""
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        return (self.credentials.expiry - now).total_seconds() - TOKEN_REFRESH_MARGIN
+    
+    def schedule(self, delay: Optional[float] = None) -> None:
+        """Schedule the next refresh, by default when the token enters the refresh margin."""
+        with self.lock:
+            if self.stopped or self.credentials.expiry is None:
+                return
+            
+            if delay is None:
+                delay = max(0.0, self.seconds_until_refresh())
+            
+            self.timer = threading.Timer(delay, self.refresh)
+            self.timer.daemon = True
+            self.timer.start()
+    
+    def refresh_now(self, stale_token: Optional[str]) -> None:
+        """
+        Refresh the token, unless it no longer is stale_token, i.e. another
+        caller renewed it since stale_token was read.
+        """
+        with self.lock:
+            if self.credentials.token != stale_token:
+                return
+            
+            self.refresh_credentials(Request())
+    
+    def refresh_credentials_locked(self, request: Request) -> None:
+        """Replacement for credentials.refresh, used by google-auth itself."""
+        self.refresh_now(self.credentials.token)
+    
+    def refresh(self) -> None:
+        """Refresh the token unless it was already renewed, then reschedule."""
+        try:
+            with self.lock:
+                if self.stopped:
+                    return
+                
+                if self.seconds_until_refresh() <= 0:
+                    logger.info("Refreshing Google token ahead of expiry")
+                    self.refresh_now(self.credentials.token)
+        except Exception as e:
+            logger.warning(f"Error refreshing token: {e}. Retrying in {TOKEN_REFRESH_RETRY_DELAY} seconds")
+            self.schedule(TOKEN_REFRESH_RETRY_DELAY)
+            return
+        
+        self.schedule()
+    
+    def start(self) -> None:
+        """Start refreshing the token in the background."""
+        self.schedule()
+    
+    def stop(self) -> None:
+        """Cancel any scheduled refresh."""
+        with self.lock:
+            self.stopped = True
+            if self.timer is not None:
+                self.timer.cancel()
+
+class RateLimiter:
+    """Token bucket allowing at most `rate` acquisitions per `period` seconds."""
+    
+    def __init__(self, rate: int, period: float):
+        self.rate = rate
+        self.period = period
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self) -> None:
+        """Block until a token is available, then take it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.period)
+                self.updated = now
+                
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                
+                wait_time = (1 - self.tokens) * self.period / self.rate
+            
+            time.sleep(wait_time)
 
 def read_sql_from_file(file_path: str) -> str:
     """Read SQL query from a file."""
@@ -114,274 +307,593 @@ def get_google_credentials(client_secret_file: str, token_path: str) -> Credenti
                 token.write(credentials.to_json())
             logger.info(f"Token saved to {token_path}")
     
+    # Refresh the token in a background thread once it is close to expiry,
+    # while requests keep using the still-valid token. Concurrent requests
+    # share a single in-flight refresh; only an expired token blocks
+    credentials.with_non_blocking_refresh()
+    
     return credentials
 
-def execute_trino_query(config: Dict[str, Any], sql_query: str) -> pd.DataFrame:
-    """Connect to Trino database and execute query, returning a pandas DataFrame."""
+def read_trino_query_partitioned(config: AppConfig, sql_query: str) -> pd.DataFrame:
+    """
+    Execute query with connectorx, fetching partitions of the result in parallel
+    and converting them to a pandas DataFrame through Arrow.
+    
+    connectorx does not take a default schema, so tables in the query must be
+    qualified with their schema.
+    """
+    try:
+        import connectorx
+    except ImportError:
+        raise RuntimeError(
+            "TRINO_PARTITION_ON is set but connectorx is not installed "
+            "(pip install -e '.[connectorx]')"
+        )
+    
+    trino_url = (
+        f"trino+https://{quote(config.trino.user, safe='')}:"
+        f"{quote(config.trino.password or '', safe='')}@"
+        f"{config.trino.host}:{config.trino.port}/{config.trino.catalog}"
+    )
+    
+    logger.info(
+        f"Executing SQL query with connectorx, partitioned on {config.trino.partition_on} "
+        f"into {config.trino.partition_num} partitions"
+    )
+    return connectorx.read_sql(
+        trino_url,
+        sql_query,
+        partition_on=config.trino.partition_on,
+        partition_num=config.trino.partition_num,
+        return_type='pandas'
+    )
+
+def execute_trino_query(config: AppConfig, sql_query: str) -> Iterator[pd.DataFrame]:
+    """
+    Connect to Trino database and execute query, yielding the results as pandas
+    DataFrames of at most BATCH_SIZE rows.
+    
+    Rows are streamed from the cursor with fetchmany, so only one batch is held
+    in memory at a time. The first DataFrame is always yielded, even when the
+    query returns no rows, so the header can be written.
+    
+    If a partition column is configured, the query is instead read in full with
+    connectorx and the resulting DataFrame is yielded in slices.
+    """
+    if config.trino.partition_on:
+        try:
+            df = read_trino_query_partitioned(config, sql_query)
+        except Exception as e:
+            raise RuntimeError(f"Failed to execute Trino query: {e}")
+        
+        logger.info(f"Query executed successfully. Fetched {len(df)} rows")
+        yield df.iloc[:BATCH_SIZE]
+        for start in range(BATCH_SIZE, len(df), BATCH_SIZE):
+            yield df.iloc[start:start + BATCH_SIZE]
+        return
+    
     logger.info("Connecting to Trino database")
     try:
         conn = trino.dbapi.connect(
-            host=config['trino']['host'],
-            port=config['trino']['port'],
-            user=config['trino']['user'],
-            catalog=config['trino']['catalog'],
-            schema=config['trino']['schema'],
+            host=config.trino.host,
+            port=config.trino.port,
+            user=config.trino.user,
+            catalog=config.trino.catalog,
+            schema=config.trino.schema,
             http_scheme='https',
-            auth=trino.auth.BasicAuthentication(config['trino']['user'], config['trino']['password'])
+            auth=trino.auth.BasicAuthentication(config.trino.user, config.trino.password)
         )
-        
+    except Exception as e:
+        raise RuntimeError(f"Failed to execute Trino query: {e}")
+    
+    try:
         logger.info("Executing SQL query")
-        # Use pandas to directly read from the SQL connection
-        df = pd.read_sql(sql_query, conn)
+        cur = conn.cursor()
+        cur.execute(sql_query)
         
-        logger.info(f"Query executed successfully. Fetched {len(df)} rows")
+        rows = cur.fetchmany(BATCH_SIZE)
+        columns = [column[0] for column in cur.description]
+        total_rows = 0
         
-        # Close connection
-        conn.close()
+        while True:
+            total_rows += len(rows)
+            yield pd.DataFrame.from_records(rows, columns=columns)
+            
+            rows = cur.fetchmany(BATCH_SIZE)
+            if not rows:
+                break
         
-        return df
+        logger.info(f"Query executed successfully. Fetched {total_rows} rows")
     
     except Exception as e:
         raise RuntimeError(f"Failed to execute Trino query: {e}")
+    
+    finally:
+        # Close connection
+        conn.close()
 
 def prepare_dataframe_for_sheets(df: pd.DataFrame) -> pd.DataFrame:
     """
     Prepare DataFrame for Google Sheets by converting all values to JSON-serializable types.
     
-    This function:
-    1. Creates a deep copy of the DataFrame
-    2. Converts date/datetime columns to strings
-    3. Converts any non-serializable values to strings
-    4. Replaces NaN/None values with None (which is JSON serializable)
+    Each column is converted once, based on its dtype:
+    1. Datetime columns are formatted as ISO 8601 strings (to the second) in numpy
+    2. Object, category and extension-dtype columns get NaN/None/NaT/NA replaced
+       with None, and are converted to strings if infer_dtype reports non-JSON-native
+       values (e.g. Decimal, date)
+    3. Numeric columns are left untouched; orjson writes NaN/inf floats as null
+    
+    Converted columns replace the originals in place, so no copy of the
+    DataFrame is made; callers pass chunks they no longer need. No JSON
+    serialization probe is performed; the payload is serialized once, with
+    orjson, when the request is built.
     
     Returns:
-        Modified DataFrame with all values JSON-serializable
+        The same DataFrame, with all values JSON-serializable
     """
-    # Make a deep copy to avoid modifying the original
-    df_copy = df.copy(deep=True)
+    for i in range(df.shape[1]):
+        series = df.iloc[:, i]
+        
+        # Only numpy dtypes (and tz-aware datetimes) are dispatched on their kind.
+        # Extension dtypes such as nullable Int64/boolean or string hold pd.NA,
+        # so they go through the object path even when their kind is numeric
+        if isinstance(series.dtype, (np.dtype, pd.DatetimeTZDtype)):
+            kind = series.dtype.kind
+        else:
+            kind = 'O'
+        
+        if kind == 'M':
+            if isinstance(series.dtype, pd.DatetimeTZDtype):
+                # Timezone-aware values are written in UTC, with a 'Z' suffix
+                values = np.datetime_as_string(
+                    series.dt.tz_convert('UTC').dt.tz_localize(None).to_numpy(), unit='s', timezone='UTC'
+                )
+            else:
+                values = np.datetime_as_string(series.to_numpy(), unit='s')
+            values = np.where(series.isna().to_numpy(), None, values.astype(object))
+        elif kind == 'm':
+            values = series.astype(str).to_numpy(dtype=object)
+            values = np.where(series.isna().to_numpy(), None, values)
+        elif kind in 'iubf':
+            continue
+        else:
+            values = series.to_numpy(dtype=object)
+            missing = pd.isna(values)
+            if pd.api.types.infer_dtype(values, skipna=True) not in JSON_NATIVE_TYPES:
+                values = series.astype(str).to_numpy(dtype=object)
+            values = np.where(missing, None, values)
+        
+        # Wrap the array explicitly so pandas does not re-infer the object column
+        df.isetitem(i, pd.Series(values, index=df.index, dtype=object, copy=False))
     
-    # Convert date/datetime columns to strings
-    date_cols = df_copy.select_dtypes(include=['datetime', 'datetime64', 'datetime64[ns]']).columns
-    for col in date_cols:
-        df_copy[col] = df_copy[col].astype(str)
+    return df
+
+def build_google_service(service_name: str, version: str, credentials: Credentials) -> Resource:
+    """
+    Build a Google API client. Discovery documents are loaded from the copies
+    bundled with googleapiclient rather than fetched over HTTPS.
+    """
+    return build(
+        service_name,
+        version,
+        credentials=credentials,
+        cache_discovery=False,
+        static_discovery=True
+    )
+
+def is_retryable_error(error: HttpError) -> bool:
+    """Check whether a Google API error is transient and the call worth retrying."""
+    if error.resp.status in RETRYABLE_STATUS_CODES:
+        return True
     
-    # Replace NaN/None with None (which is JSON serializable)
-    df_copy = df_copy.replace({pd.NA: None, pd.NaT: None})
-    df_copy = df_copy.where(pd.notnull(df_copy), None)
+    # Drive reports rate limiting as 403
+    if error.resp.status == 403:
+        details = error.error_details if isinstance(error.error_details, list) else []
+        reasons = {detail.get('reason') for detail in details if isinstance(detail, dict)}
+        return 'retry-after' in error.resp or bool(reasons & RATE_LIMIT_REASONS)
     
-    # Verify all columns are serializable and convert if necessary
-    for col in df_copy.columns:
+    return False
+
+def get_backoff_delay(base_delay: float, retry: int) -> float:
+    """
+    Exponential backoff delay for the given retry, capped at MAX_RETRY_DELAY and
+    randomized so concurrent requests do not retry in lockstep.
+    """
+    return min(MAX_RETRY_DELAY, base_delay * (2 ** retry)) * random.uniform(0.5, 1.5)
+
+def get_retry_delay(error: HttpError, retry: int) -> float:
+    """
+    Get the number of seconds to wait before retrying a failed Google API call.
+    
+    A Retry-After header sent by the server is used as-is. Otherwise the delay
+    backs off exponentially, from a longer base for quota errors (403/429) than
+    for server errors.
+    """
+    retry_after = error.resp.get('retry-after')
+    if retry_after:
         try:
-            # Test JSON serialization on this column
-            json.dumps(df_copy[col].tolist())
-        except (TypeError, OverflowError):
-            # If not serializable, convert to strings
-            df_copy[col] = df_copy[col].astype(str)
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+        try:
+            retry_at = parsedate_to_datetime(retry_after)
+            return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            logger.warning(f"Ignoring invalid Retry-After header: {retry_after}")
     
-    # Test the entire DataFrame can be serialized
-    try:
-        json.dumps(df_copy.values.tolist())
-    except (TypeError, OverflowError) as e:
-        logger.warning(f"DataFrame still contains non-serializable values: {e}")
-        # Last resort: convert the entire DataFrame to strings
-        for col in df_copy.columns:
-            df_copy[col] = df_copy[col].astype(str)
+    base_delay = QUOTA_RETRY_DELAY if error.resp.status in (403, 429) else INITIAL_RETRY_DELAY
+    return get_backoff_delay(base_delay, retry)
+
+def get_http_error_wait_time(error: HttpError, retry: int, error_message: str) -> float:
+    """
+    Get the number of seconds to wait before retrying a failed Google API call,
+    or raise RuntimeError if the error is not retryable or retries are exhausted.
+    """
+    if retry >= MAX_RETRIES - 1 or not is_retryable_error(error):
+        # If we've exhausted retries or the error is not retryable, raise it
+        raise RuntimeError(f"{error_message}: {error}")
+    
+    wait_time = get_retry_delay(error, retry)
+    logger.warning(f"Google API error: {error}. Retrying in {wait_time:.1f} seconds (attempt {retry+1}/{MAX_RETRIES})")
+    return wait_time
+
+def retry_api(error_message: str) -> Callable:
+    """
+    Decorator retrying a Google API call on transient errors.
+    
+    Errors that are not retried, or persist after MAX_RETRIES attempts, are
+    raised as RuntimeError prefixed with error_message.
     
-    return df_copy
+    Synchronous functions must take the Google API service as their first
+    argument: on a stale connection error the service's pooled connections are
+    closed before retrying. 401 responses are not handled for them, as
+    AuthorizedHttp already refreshes the token and replays the request once.
+    
+    Coroutine functions are retried with asyncio.sleep, and on aiohttp
+    connection errors or timeouts, which the session recovers from by itself.
+    These back off like server errors, except for a pooled connection closed by
+    the server, which is retried at once on a new connection.
+    """
+    def decorator(func: Callable) -> Callable:
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                for retry in range(MAX_RETRIES):
+                    try:
+                        return await func(*args, **kwargs)
+                    
+                    except HttpError as e:
+                        await asyncio.sleep(get_http_error_wait_time(e, retry, error_message))
+                    
+                    except aiohttp.ServerDisconnectedError as e:
+                        if retry >= MAX_RETRIES - 1:
+                            raise RuntimeError(f"{error_message}: {e!r}")
+                        
+                        logger.warning(f"Stale connection to Google API: {e!r}. Reconnecting (attempt {retry+1}/{MAX_RETRIES})")
+                    
+                    except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                        if retry >= MAX_RETRIES - 1:
+                            raise RuntimeError(f"{error_message}: {e!r}")
+                        
+                        wait_time = get_backoff_delay(INITIAL_RETRY_DELAY, retry)
+                        logger.warning(f"Connection error to Google API: {e!r}. Retrying in {wait_time:.1f} seconds (attempt {retry+1}/{MAX_RETRIES})")
+                        await asyncio.sleep(wait_time)
+                    
+                    except Exception as e:
+                        raise RuntimeError(f"{error_message}: {e}")
+                
+                # This should never be reached due to the raise in the except block
+                raise RuntimeError(f"{error_message} after retries")
+            
+            return async_wrapper
+        
+        @functools.wraps(func)
+        def wrapper(service: Resource, *args, **kwargs):
+            for retry in range(MAX_RETRIES):
+                try:
+                    return func(service, *args, **kwargs)
+                
+                except HttpError as e:
+                    time.sleep(get_http_error_wait_time(e, retry, error_message))
+                
+                except STALE_CONNECTION_ERRORS as e:
+                    if retry >= MAX_RETRIES - 1:
+                        raise RuntimeError(f"{error_message}: {e}")
+                    
+                    # Drop the pooled connections so the next attempt reconnects
+                    logger.warning(f"Stale connection to Google API: {e}. Reconnecting (attempt {retry+1}/{MAX_RETRIES})")
+                    service.close()
+                
+                except Exception as e:
+                    raise RuntimeError(f"{error_message}: {e}")
+            
+            # This should never be reached due to the raise in the except block
+            raise RuntimeError(f"{error_message} after retries")
+        
+        return wrapper
+    
+    return decorator
 
-def create_google_sheet(credentials: Credentials, title: str) -> str:
+@retry_api("Failed to create Google Sheet")
+def create_google_sheet(sheets_service: Resource, title: str) -> str:
     """Create a new Google Sheet and return its ID."""
     logger.info(f"Creating new Google Sheet: {title}")
     
-    # Standard retry parameters
-    MAX_RETRIES = 5
-    INITIAL_RETRY_DELAY = 1
+    # Create spreadsheet
+    spreadsheet = {
+        'properties': {
+            'title': title
+        }
+    }
+    
+    response = sheets_service.spreadsheets().create(
+        body=spreadsheet, 
+        fields='spreadsheetId'
+    ).execute()
+    
+    spreadsheet_id = response.get('spreadsheetId')
+    logger.info(f"Created spreadsheet with ID: {spreadsheet_id}")
     
-    for retry in range(MAX_RETRIES):
+    return spreadsheet_id
+
+def iterate_in_thread(iterable: Iterable, maxsize: int = PIPELINE_QUEUE_SIZE) -> Iterator:
+    """
+    Iterate over iterable in a background thread, buffering up to maxsize items
+    in a bounded queue, so producing the next items overlaps with consuming the
+    current one. Exceptions raised by the iterable are re-raised to the consumer.
+    
+    The background thread stops once the returned iterator is closed or garbage
+    collected, even when the queue is full, and then closes the iterable if it
+    is a generator, so upstream pipeline stages stop in turn.
+    """
+    items = queue.Queue(maxsize=maxsize)
+    stopped = threading.Event()
+    
+    def put(entry: Tuple[str, Any]) -> None:
+        while not stopped.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+    
+    def produce() -> None:
         try:
-            # Build the service
-            sheets_service = build('sheets', 'v4', credentials=credentials)
+            for item in iterable:
+                put(('item', item))
+                if stopped.is_set():
+                    return
+            put(('done', None))
+        except Exception as e:
+            put(('error', e))
+        finally:
+            # Closed from this thread, the only one iterating over it
+            close = getattr(iterable, 'close', None)
+            if close is not None:
+                close()
+    
+    threading.Thread(target=produce, daemon=True).start()
+    
+    try:
+        while True:
+            kind, value = items.get()
+            if kind == 'done':
+                return
+            if kind == 'error':
+                raise value
+            yield value
+    finally:
+        stopped.set()
+
+def prepare_sheet_values(chunks: Iterable[pd.DataFrame]) -> Iterator[Tuple[orjson.Fragment, int, int]]:
+    """
+    Convert DataFrame chunks to sheet rows. The header row is yielded first, as
+    its own batch, followed by one batch per non-empty chunk.
+    
+    Rows are yielded already serialized, as an orjson.Fragment that orjson
+    embeds as-is in the request body, so the exact request size is known.
+    
+    Chunks whose columns all share one numeric or bool numpy dtype need no
+    conversion: they skip prepare_dataframe_for_sheets and are serialized
+    directly from a 2D numpy array (NaN/inf as null), without boxing every
+    cell into Python objects.
+    
+    Yields:
+        Tuples of (rows, JSON size in bytes, number of sheet rows)
+    """
+    try:
+        for i, chunk in enumerate(chunks):
+            if i == 0:
+                header = orjson.dumps([chunk.columns.tolist()])
+                yield orjson.Fragment(header), len(header), 1
             
-            # Create spreadsheet
-            spreadsheet = {
-                'properties': {
-                    'title': title
-                }
-            }
+            if chunk.empty:
+                continue
             
-            response = sheets_service.spreadsheets().create(
-                body=spreadsheet, 
-                fields='spreadsheetId'
-            ).execute()
+            dtypes = set(chunk.dtypes)
+            if len(dtypes) == 1:
+                dtype = dtypes.pop()
+                if isinstance(dtype, np.dtype) and dtype.kind in 'iufb' and dtype.itemsize <= 8:
+                    values = orjson.dumps(np.ascontiguousarray(chunk.to_numpy()), option=orjson.OPT_SERIALIZE_NUMPY)
+                    yield orjson.Fragment(values), len(values), len(chunk)
+                    continue
             
-            spreadsheet_id = response.get('spreadsheetId')
-            logger.info(f"Created spreadsheet with ID: {spreadsheet_id}")
+            # Convert DataFrame to serializable format
+            df_prepared = prepare_dataframe_for_sheets(chunk)
             
-            return spreadsheet_id
+            # Convert to values list column by column. Unlike df.values, this does
+            # not box every cell into an intermediate object array
+            columns = [df_prepared.iloc[:, j].to_numpy().tolist() for j in range(df_prepared.shape[1])]
+            values = orjson.dumps(list(map(list, zip(*columns))))
+            yield orjson.Fragment(values), len(values), len(df_prepared)
+    finally:
+        # Stop the upstream pipeline stage too when this generator is closed early
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+@retry_api("Failed to write data to Google Sheet")
+async def batch_update_values(
+    session: aiohttp.ClientSession,
+    token_refresher: TokenRefresher,
+    spreadsheet_id: str,
+    data: List[Dict[str, Any]]
+) -> None:
+    """
+    Write several value ranges to the Google Sheet in a single batchUpdate
+    request, posted straight to the Sheets REST API.
+    
+    A 401 response forces a token refresh through token_refresher, so
+    concurrent requests rejected with the same token only refresh it once.
+    """
+    credentials = token_refresher.credentials
+    url = f"{SHEETS_API_URL}/spreadsheets/{spreadsheet_id}/values:batchUpdate"
+    body = orjson.dumps(
+        {
+            'valueInputOption': 'RAW',
+            'data': data,
+            # Don't echo the written values back
+            'includeValuesInResponse': False
+        }
+    )
+    # The response is not used, so only request its smallest field
+    params = {'fields': 'spreadsheetId'}
+    
+    for attempt in range(2):
+        # Let google-auth apply the token, refreshing it first if needed. This
+        # can block on the token endpoint, so it runs off the event loop
+        headers = {'content-type': 'application/json'}
+        await asyncio.to_thread(credentials.before_request, Request(), 'POST', url, headers)
+        signed_token = credentials.token
+        
+        async with session.post(url, params=params, data=body, headers=headers) as response:
+            if response.status == 401 and attempt == 0:
+                # The token was rejected: refresh it, unless another request already
+                # did, and replay the request once
+                await asyncio.to_thread(token_refresher.refresh_now, signed_token)
+                continue
             
-        except HttpError as e:
-            if retry >= MAX_RETRIES - 1 or e.resp.status not in [429, 500, 502, 503, 504]:
-                # If we've exhausted retries or the error is not retryable, raise it
-                raise RuntimeError(f"Failed to create Google Sheet: {e}")
+            if response.status >= 400:
+                # Raised as HttpError so failures are retried and reported like googleapiclient calls
+                headers = {key.lower(): value for key, value in response.headers.items()}
+                raise HttpError(
+                    httplib2.Response({**headers, 'status': response.status}),
+                    await response.read(),
+                    uri=url
+                )
             
-            # Calculate backoff time
-            wait_time = INITIAL_RETRY_DELAY * (2 ** retry)
-            logger.warning(f"Google API error: {e}. Retrying in {wait_time} seconds (attempt {retry+1}/{MAX_RETRIES})")
-            time.sleep(wait_time)
-        
-        except Exception as e:
-            raise RuntimeError(f"Failed to create Google Sheet: {e}")
-    
-    # This should never be reached due to the raise in the except block
-    raise RuntimeError("Failed to create Google Sheet after retries")
+            return
 
-def write_dataframe_to_sheet(
-    credentials: Credentials,
+async def write_dataframe_to_sheet(
+    token_refresher: TokenRefresher,
     spreadsheet_id: str,
-    df: pd.DataFrame
+    chunks: Iterable[pd.DataFrame]
 ) -> None:
-    """Write pandas DataFrame to the Google Sheet."""
-    logger.info("Writing data to Google Sheet")
+    """
+    Write pandas DataFrame chunks to the Google Sheet.
     
-    # Standard retry parameters
-    MAX_RETRIES = 5
-    INITIAL_RETRY_DELAY = 1
+    The header row and each chunk become one value range each, starting at the
+    row after the previous one. Ranges are collected and sent together in as
+    few batchUpdate requests as the request size limit allows.
     
-    # Convert DataFrame to serializable format
-    logger.info("Preparing data for serialization")
-    df_prepared = prepare_dataframe_for_sheets(df)
+    Requests are posted concurrently with aiohttp while the next chunks are
+    fetched and prepared in a pipeline of background threads. At most
+    MAX_CONCURRENT_WRITES requests are in flight, and they are started no
+    faster than the per-user write quota allows.
+    """
+    logger.info("Writing data to Google Sheet")
     
-    # Convert to values list
-    values = [df_prepared.columns.tolist()] + df_prepared.values.tolist()
+    rate_limiter = RateLimiter(WRITE_REQUESTS_PER_MINUTE, 60)
+    # Bounds the number of requests, and so payloads, in flight at once
+    in_flight = asyncio.Semaphore(MAX_CONCURRENT_WRITES)
+    tasks = []
     
-    # Use batching for large datasets (Google Sheets has limits)
-    BATCH_SIZE = 5000
+    async def send(session: aiohttp.ClientSession, data: List[Dict[str, Any]]) -> None:
+        try:
+            await batch_update_values(session, token_refresher, spreadsheet_id, data)
+            logger.info(f"Wrote {len(data)} range(s) starting at {data[0]['range']}")
+        finally:
+            in_flight.release()
     
-    # Split into batches if necessary
-    if len(values) > BATCH_SIZE:
-        batches = [values[i:i + BATCH_SIZE] for i in range(0, len(values), BATCH_SIZE)]
-        logger.info(f"Data too large, splitting into {len(batches)} batches")
+    async def submit(session: aiohttp.ClientSession, data: List[Dict[str, Any]]) -> None:
+        # Surface failures of earlier requests before queueing more data
+        for task in tasks:
+            if task.done():
+                task.result()
         
-        for retry in range(MAX_RETRIES):
-            try:
-                # Build the service for each attempt to avoid stale connections
-                sheets_service = build('sheets', 'v4', credentials=credentials)
-                
-                # Process batches
-                for i, batch in enumerate(batches):
-                    start_range = f'Sheet1!A{1 if i == 0 else (i * BATCH_SIZE) + 1}'
-                    
-                    # Use update for first batch (with headers), append for the rest
-                    if i == 0:
-                        sheets_service.spreadsheets().values().update(
-                            spreadsheetId=spreadsheet_id,
-                            range=start_range,
-                            valueInputOption='RAW',
-                            body={'values': batch}
-                        ).execute()
-                    else:
-                        sheets_service.spreadsheets().values().append(
-                            spreadsheetId=spreadsheet_id,
-                            range=start_range,
-                            valueInputOption='RAW',
-                            insertDataOption='INSERT_ROWS',
-                            body={'values': batch}
-                        ).execute()
-                    
-                    logger.info(f"Batch {i+1}/{len(batches)} written")
-                
-                logger.info(f"Successfully wrote {len(df)} rows to Google Sheet")
-                return
+        await in_flight.acquire()
+        await asyncio.to_thread(rate_limiter.acquire)
+        tasks.append(asyncio.create_task(send(session, data)))
+    
+    # Value ranges waiting to be sent, and their payload size
+    pending = []
+    pending_bytes = 0
+    
+    # Number of sheet rows written so far, including the header
+    written_rows = 0
+    
+    # Chunks are fetched and prepared in two background threads, connected by
+    # bounded queues, while this loop sends the requests
+    batches = iterate_in_thread(prepare_sheet_values(iterate_in_thread(chunks)))
+    
+    async with aiohttp.ClientSession() as session:
+        try:
+            while True:
+                # Wait for the next batch off the event loop, so requests in flight keep progressing
+                batch = await asyncio.to_thread(next, batches, None)
+                if batch is None:
+                    break
                 
-            except HttpError as e:
-                if retry >= MAX_RETRIES - 1 or e.resp.status not in [429, 500, 502, 503, 504]:
-                    raise RuntimeError(f"Failed to write data to Google Sheet: {e}")
+                values, batch_bytes, rows = batch
+                if pending and pending_bytes + batch_bytes > MAX_REQUEST_BYTES:
+                    await submit(session, pending)
+                    pending = []
+                    pending_bytes = 0
                 
-                wait_time = INITIAL_RETRY_DELAY * (2 ** retry)
-                logger.warning(f"Google API error: {e}. Retrying in {wait_time} seconds (attempt {retry+1}/{MAX_RETRIES})")
-                time.sleep(wait_time)
+                pending.append({'range': f'Sheet1!A{written_rows + 1}', 'values': values})
+                pending_bytes += batch_bytes
+                written_rows += rows
             
-            except Exception as e:
-                raise RuntimeError(f"Failed to write data to Google Sheet: {e}")
-    else:
-        # For smaller datasets, write in a single operation
-        for retry in range(MAX_RETRIES):
-            try:
-                # Build the service for each attempt to avoid stale connections
-                sheets_service = build('sheets', 'v4', credentials=credentials)
-                
-                sheets_service.spreadsheets().values().update(
-                    spreadsheetId=spreadsheet_id,
-                    range='Sheet1!A1',
-                    valueInputOption='RAW',
-                    body={'values': values}
-                ).execute()
-                
-                logger.info(f"Successfully wrote {len(df)} rows to Google Sheet")
-                return
-                
-            except HttpError as e:
-                if retry >= MAX_RETRIES - 1 or e.resp.status not in [429, 500, 502, 503, 504]:
-                    raise RuntimeError(f"Failed to write data to Google Sheet: {e}")
-                
-                wait_time = INITIAL_RETRY_DELAY * (2 ** retry)
-                logger.warning(f"Google API error: {e}. Retrying in {wait_time} seconds (attempt {retry+1}/{MAX_RETRIES})")
-                time.sleep(wait_time)
+            if pending:
+                await submit(session, pending)
             
-            except Exception as e:
-                raise RuntimeError(f"Failed to write data to Google Sheet: {e}")
+            # Wait for all requests, raising the first failure
+            await asyncio.gather(*tasks)
+        finally:
+            # If a write failed, cancel the requests still in flight and stop
+            # the fetch and prepare threads
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            batches.close()
     
-    # This should never be reached due to the raise in the except block
-    raise RuntimeError("Failed to write data to Google Sheet after retries")
+    logger.info(f"Successfully wrote {written_rows - 1} rows to Google Sheet in {len(tasks)} request(s)")
 
+@retry_api("Failed to move Google Sheet to folder")
 def move_sheet_to_folder(
-    credentials: Credentials,
+    drive_service: Resource,
     file_id: str,
     folder_id: str
 ) -> None:
     """Move the Google Sheet to the specified folder."""
     logger.info(f"Moving Google Sheet to folder ID: {folder_id}")
     
-    # Standard retry parameters
-    MAX_RETRIES = 5
-    INITIAL_RETRY_DELAY = 1
+    # Get current parents
+    file = drive_service.files().get(
+        fileId=file_id, fields='parents'
+    ).execute()
     
-    for retry in range(MAX_RETRIES):
-        try:
-            # Build the service
-            drive_service = build('drive', 'v3', credentials=credentials)
-            
-            # Get current parents
-            file = drive_service.files().get(
-                fileId=file_id, fields='parents'
-            ).execute()
-            
-            previous_parents = ",".join(file.get('parents', []))
-            
-            # Move file to new folder
-            drive_service.files().update(
-                fileId=file_id,
-                addParents=folder_id,
-                removeParents=previous_parents,
-                fields='id, parents'
-            ).execute()
-            
-            logger.info("Successfully moved Google Sheet to specified folder")
-            return
-            
-        except HttpError as e:
-            if retry >= MAX_RETRIES - 1 or e.resp.status not in [429, 500, 502, 503, 504]:
-                raise RuntimeError(f"Failed to move Google Sheet to folder: {e}")
-            
-            wait_time = INITIAL_RETRY_DELAY * (2 ** retry)
-            logger.warning(f"Google API error: {e}. Retrying in {wait_time} seconds (attempt {retry+1}/{MAX_RETRIES})")
-            time.sleep(wait_time)
-        
-        except Exception as e:
-            raise RuntimeError(f"Failed to move Google Sheet to folder: {e}")
+    previous_parents = ",".join(file.get('parents', []))
     
-    # This should never be reached due to the raise in the except block
-    raise RuntimeError("Failed to move Google Sheet to folder after retries")
+    # Move file to new folder
+    drive_service.files().update(
+        fileId=file_id,
+        addParents=folder_id,
+        removeParents=previous_parents,
+        fields='id'
+    ).execute()
+    
+    logger.info("Successfully moved Google Sheet to specified folder")
 
 def main():
     """Main function to execute the workflow."""
@@ -396,29 +908,47 @@ def main():
         # Get Google credentials
         logger.info("Authenticating with Google")
         credentials = get_google_credentials(
-            config['google']['client_secret_file'],
-            config['google']['token_path']
+            config.google.client_secret_file,
+            config.google.token_path
         )
         
-        # Execute Trino query and get results as DataFrame
-        df = execute_trino_query(config, sql_query)
-        
-        # Generate sheet title with today's date
-        today = datetime.date.today().strftime('%Y-%m-%d')
-        sheet_title = f"{today}- MB Query Export.csv"
-        
-        # Create Google Sheet
-        spreadsheet_id = create_google_sheet(credentials, sheet_title)
+        # Keep the token fresh for the whole run
+        token_refresher = TokenRefresher(credentials)
+        token_refresher.start()
         
-        # Write data to sheet
-        write_dataframe_to_sheet(credentials, spreadsheet_id, df)
+        try:
+            # Execute Trino query, streaming results as DataFrame chunks. The first
+            # chunk is fetched up front so query errors surface before a sheet is created
+            chunks = execute_trino_query(config, sql_query)
+            chunks = itertools.chain([next(chunks)], chunks)
+            
+            # Generate sheet title with today's date
+            today = datetime.date.today().strftime('%Y-%m-%d')
+            sheet_title = f"{today}- MB Query Export.csv"
+            
+            # Build the Google API clients once, so their connections are reused across calls
+            sheets_service = build_google_service('sheets', 'v4', credentials)
+            drive_service = build_google_service('drive', 'v3', credentials)
+            
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                # Create Google Sheet
+                spreadsheet_id = create_google_sheet(sheets_service, sheet_title)
+                
+                # Move sheet to the specified folder while the data is written
+                move_future = executor.submit(
+                    move_sheet_to_folder,
+                    drive_service,
+                    spreadsheet_id,
+                    config.google.drive_folder_id
+                )
+                
+                # Write data to sheet
+                asyncio.run(write_dataframe_to_sheet(token_refresher, spreadsheet_id, chunks))
+                
+                move_future.result()
         
-        # Move sheet to the specified folder
-        move_sheet_to_folder(
-            credentials,
-            spreadsheet_id,
-            config['google']['drive_folder_id']
-        )
+        finally:
+            token_refresher.stop()
         
         logger.info("Script completed successfully")
         